@@ -1,3 +1,4 @@
+from optimization.BendersMaster import BendersMaster
 from optimization.ProblemConfiguration import ProblemConfiguration
 from optimization.StorageSelectionProblem import StorageSelectionProblem
 
@@ -21,18 +22,30 @@ if __name__ == '__main__':
     configuration.storage_price_per_kwh_in_euro = 50
     configuration.price_per_module_in_euro = 850
 
-    problem = StorageSelectionProblem(configuration)
-    problem.buildModel()
-    problem.solver.EnableOutput()
-    print('Starting to solve problem. Problem characteristics:')
-    print('variables:', problem.solver.NumVariables())
-    print('constraints:', problem.solver.NumConstraints())
-    # delete old file if it exists
-    with open('model.txt', 'w+') as file:
-        file.truncate(0)
-        file.write(problem.solver.ExportModelAsLpFormat(False))
-    problem.solver.Solve()
-
-    print('Modules:', problem.base_variables['numberOfModules'].solution_value())
-
-    print('Storage:', problem.base_variables['sizeOfStorageInKwh'].solution_value())
+    if configuration.use_benders_decomposition:
+        master = BendersMaster(configuration)
+        master.buildModel()
+        print('Starting to solve problem with benders decomposition, scenarios:', configuration.number_of_scenarios)
+        master.solve()
+
+        print('Modules:', master.solution['numberOfModules'])
+
+        print('Storage:', master.solution['sizeOfStorageInKwh'])
+    else:
+        problem = StorageSelectionProblem(configuration)
+        problem.buildModel()
+        problem.solver.EnableOutput()
+        print('Starting to solve problem. Problem characteristics:')
+        print('variables:', problem.solver.NumVariables())
+        print('constraints:', problem.solver.NumConstraints())
+        # writing the model is slow for big models and only useful for debugging, so only do it if asked for
+        if configuration.export_model_file:
+            # delete old file if it exists
+            with open(configuration.export_model_file, 'w+') as file:
+                file.truncate(0)
+                file.write(problem.solver.ExportModelAsLpFormat(False))
+        problem.solve()
+
+        print('Modules:', problem.base_variables['numberOfModules'].solution_value())
+
+        print('Storage:', problem.base_variables['sizeOfStorageInKwh'].solution_value())
\ No newline at end of file
@@ -0,0 +1,168 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import ortools.linear_solver.pywraplp as LPSolving
+from ortools.linear_solver import linear_solver_pb2
+from ortools.linear_solver.pywraplp import Solver
+
+from .ProblemConfiguration import ProblemConfiguration
+from .StorageSelectionProblem import StorageSelectionProblem
+import logging
+
+# the scenario subproblems of this process and their solvers, a solver is kept around so it can warm start
+# in the next iteration (only the bounds of the base variables change)
+_subproblems: dict[int, bytes] = {}
+_subproblem_solvers: dict[int, Solver] = {}
+
+
+def _initSubproblems(subproblems: dict[int, bytes]):
+    global _subproblems, _subproblem_solvers
+    _subproblems = subproblems
+    _subproblem_solvers = {}
+
+
+def _solveSubproblems(number_of_modules: int, size_of_storage_in_kwh: float) -> dict[int, tuple[float, float, float]]:
+    return {scenario: _solveSubproblem(number_of_modules, size_of_storage_in_kwh, scenario) for scenario in _subproblems}
+
+
+def _solveSubproblem(number_of_modules: int, size_of_storage_in_kwh: float, scenario: int) -> tuple[float, float, float]:
+    solver = _subproblem_solvers.get(scenario)
+    if solver is None:
+        # the subproblems are pure LPs, so GLOP it is (and unlike SCIP it gives us duals / reduced costs)
+        solver = LPSolving.Solver.CreateSolver('GLOP')
+        model = linear_solver_pb2.MPModelProto()
+        model.ParseFromString(_subproblems[scenario])
+        error = solver.LoadModelFromProtoKeepNames(model)
+        if error:
+            raise RuntimeError(f'could not load subproblem of scenarioNr_{scenario} into solver: {error}')
+        _subproblem_solvers[scenario] = solver
+
+    modules = solver.LookupVariable('numberOfModules')
+    storage = solver.LookupVariable('sizeOfStorageInKwh')
+    modules.SetBounds(number_of_modules, number_of_modules)
+    storage.SetBounds(size_of_storage_in_kwh, size_of_storage_in_kwh)
+    status = solver.Solve()
+    if status != Solver.OPTIMAL:
+        # we can always buy or sell what is missing, so this should not happen
+        raise RuntimeError(f'subproblem of scenarioNr_{scenario} could not be solved, status {status}')
+
+    # the reduced cost of a fixed variable is how much the costs change if we move it a little
+    return solver.Objective().Value(), modules.reduced_cost(), storage.reduced_cost()
+
+
+class BendersMaster:
+    def __init__(self, problem_configuration: ProblemConfiguration):
+        # the master only holds the investment and one cost estimate per scenario, so it is tiny - SCIP handles the integer
+        self.solver: Solver = LPSolving.Solver.CreateSolver('SCIP')
+        self.problem_configuration: ProblemConfiguration = problem_configuration
+        self.base_variables: dict[str, LPSolving.Variable] = {}
+        self.scenario_costs: list[LPSolving.Variable] = []
+        self.subproblems: list[bytes] = []
+        # best investment found while solving and its (investment + expected energy) costs
+        self.solution: dict[str, float] = {}
+        self.costs: float = math.inf
+        logging.basicConfig(level=logging.DEBUG)
+
+    def buildModel(self):
+        # this is the same problem as StorageSelectionProblem, but cut into pieces: the master picks the investment and
+        # each scenario is a subproblem (an LP with the investment fixed) that tells the master what the investment costs
+        # in energy in that scenario, and how that changes with the investment (optimality cuts)
+        logging.debug('building scenario subproblems')
+        subproblems = StorageSelectionProblem(self.problem_configuration).buildScenarioSubproblems()
+        self.subproblems = [subproblem.SerializeToString() for subproblem in subproblems]
+
+        logging.debug('building master')
+        numberOfModules = self.solver.IntVar(self.problem_configuration.min_number_of_modules,
+                                             self.problem_configuration.max_number_of_modules, 'numberOfModules')
+        sizeOfStorageInKwh = self.solver.NumVar(self.problem_configuration.min_storage_size_in_kwh,
+                                                self.problem_configuration.max_storage_size_in_kwh,
+                                                'sizeOfStorageInKwh')
+        self.base_variables = {
+            'numberOfModules': numberOfModules,
+            'sizeOfStorageInKwh': sizeOfStorageInKwh,
+        }
+        # estimated energy costs of each scenario, they are only held up by the cuts we add while solving
+        self.scenario_costs = [self.solver.NumVar(-self.solver.Infinity(), self.solver.Infinity(), f'scenarioNr_{scenario}_costs')
+                               for scenario in range(self.problem_configuration.number_of_scenarios)]
+
+        investment = numberOfModules * self.problem_configuration.price_per_module_in_euro + \
+                     sizeOfStorageInKwh * self.problem_configuration.storage_price_per_kwh_in_euro
+        self.solver.Minimize(investment + self.solver.Sum(self.scenario_costs) * (1 / self.problem_configuration.number_of_scenarios))
+        logging.debug('finished setting up model')
+
+    def solve(self) -> int:
+        number_of_scenarios = self.problem_configuration.number_of_scenarios
+        number_of_workers = min(number_of_scenarios, self.problem_configuration.number_of_workers or os.cpu_count() or 1)
+        # the master has to be solved exactly, otherwise its objective is no lower bound
+        parameters = LPSolving.MPSolverParameters()
+        parameters.SetDoubleParam(parameters.RELATIVE_MIP_GAP, 0)
+
+        # we start with the smallest investment, the cuts of the first round make the master bounded
+        number_of_modules = self.problem_configuration.min_number_of_modules
+        size_of_storage_in_kwh = self.problem_configuration.min_storage_size_in_kwh
+        lower_bound = -math.inf
+        self.solution = {}
+        self.costs = math.inf
+
+        # every worker gets its own process with a fixed share of the scenarios, so a scenario is always solved by the
+        # same process and its solver from the last iteration is still there
+        executors = []
+        if number_of_workers > 1:
+            for worker in range(number_of_workers):
+                subproblems = {scenario: self.subproblems[scenario]
+                               for scenario in range(worker, number_of_scenarios, number_of_workers)}
+                executors.append(ProcessPoolExecutor(max_workers=1, initializer=_initSubproblems, initargs=(subproblems,)))
+        else:
+            _initSubproblems(dict(enumerate(self.subproblems)))
+        try:
+            for iteration in range(self.problem_configuration.benders_max_iterations):
+                if executors:
+                    futures = [executor.submit(_solveSubproblems, number_of_modules, size_of_storage_in_kwh)
+                               for executor in executors]
+                    scenario_results = {}
+                    for future in futures:
+                        scenario_results.update(future.result())
+                else:
+                    scenario_results = _solveSubproblems(number_of_modules, size_of_storage_in_kwh)
+                results = [scenario_results[scenario] for scenario in range(number_of_scenarios)]
+
+                # the investment we just looked at is a real solution, so its costs are an upper bound
+                costs = number_of_modules * self.problem_configuration.price_per_module_in_euro + \
+                        size_of_storage_in_kwh * self.problem_configuration.storage_price_per_kwh_in_euro + \
+                        sum(scenario_cost for scenario_cost, _, _ in results) / number_of_scenarios
+                if costs < self.costs:
+                    self.costs = costs
+                    self.solution = {
+                        'numberOfModules': number_of_modules,
+                        'sizeOfStorageInKwh': size_of_storage_in_kwh,
+                    }
+                logging.debug(f'iteration {iteration}: {number_of_modules} modules, {size_of_storage_in_kwh} kWh storage, '
+                              f'costs {costs}, best {self.costs}, lower bound {lower_bound}')
+                if self.costs - lower_bound <= self.problem_configuration.benders_tolerance * max(1.0, abs(self.costs)):
+                    return Solver.OPTIMAL
+
+                # the energy costs of a scenario are convex in the investment, so they are at least the costs we just got
+                # plus the slope times the change of the investment:
+                # scenario costs - modules slope * modules - storage slope * storage >= costs - slopes * current investment
+                for scenario, (scenario_cost, modules_slope, storage_slope) in enumerate(results):
+                    cut = self.solver.Constraint(scenario_cost - modules_slope * number_of_modules -
+                                                 storage_slope * size_of_storage_in_kwh, self.solver.Infinity())
+                    cut.SetCoefficient(self.scenario_costs[scenario], 1)
+                    cut.SetCoefficient(self.base_variables['numberOfModules'], -modules_slope)
+                    cut.SetCoefficient(self.base_variables['sizeOfStorageInKwh'], -storage_slope)
+
+                status = self.solver.Solve(parameters)
+                if status != Solver.OPTIMAL:
+                    return status
+                lower_bound = self.solver.Objective().Value()
+                number_of_modules = round(self.base_variables['numberOfModules'].solution_value())
+                size_of_storage_in_kwh = self.base_variables['sizeOfStorageInKwh'].solution_value()
+        finally:
+            for executor in executors:
+                executor.shutdown()
+            # without workers the subproblems and their solvers live in this process, so let them go
+            _initSubproblems({})
+
+        # out of iterations, self.solution is the best we found but it might not be optimal
+        return Solver.FEASIBLE
@@ -12,6 +12,34 @@ class ProblemConfiguration:
         self.min_storage_size_in_kwh = 0
         self.max_storage_size_in_kwh = 1000
 
+        # buying costs 50 cts per kWh, selling earns 12 cents
+        self.energy_purchase_price_per_kwh_in_euro = 0.5
+        self.energy_selling_price_per_kwh_in_euro = 0.12
+
         self.number_of_scenarios = 10
+        # processes used to build the scenarios, None means one per scenario (at most one per cpu)
+        self.number_of_workers = None
 
         self.number_of_days = 365
+
+        # seed for sampling the scenarios, None gives different scenarios on every run
+        self.seed = None
+
+        # show progress bars while building the model
+        self.verbose = True
+
+        # any solver ortools knows, MIP solvers (SCIP, CBC, ...) solve the model directly,
+        # LP solvers (GLOP, CLP, PDLP) solve the relaxation and then round the number of modules
+        self.solver_name = 'CLP'
+
+        # solver specific parameters, one "name = value" per line (e.g. "separating/maxrounds = 0" for SCIP)
+        # empty means the solver defaults
+        self.solver_parameters = ''
+
+        # solve the scenarios separately with a benders decomposition (see BendersMaster) instead of one big model
+        self.use_benders_decomposition = False
+        self.benders_tolerance = 1e-6
+        self.benders_max_iterations = 100
+
+        # file the model is written to in LP format (e.g. 'model.txt'), None means it is not written at all
+        self.export_model_file = None
@@ -0,0 +1,8 @@
+from enum import IntEnum
+
+
+class ScenarioVariable(IntEnum):
+    # position of the per timeslot variables on the last axis of the scenario variable arrays
+    STORAGE_LEVEL = 0
+    BOUGHT_ENERGY = 1
+    SOLD_ENERGY = 2
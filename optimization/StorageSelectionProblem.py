@@ -1,175 +1,293 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import numpy as np
 from tqdm import tqdm
 import ortools.linear_solver.pywraplp as LPSolving
+from ortools.linear_solver import linear_solver_pb2
 from ortools.linear_solver.pywraplp import Solver
 
 from .ProblemConfiguration import ProblemConfiguration
+from .ScenarioVariable import ScenarioVariable
 import logging
 
 
 class StorageSelectionProblem:
     def __init__(self, problem_configuration: ProblemConfiguration):
-        self.solver: Solver = LPSolving.Solver.CreateSolver('SCIP')
+        self.solver: Solver = LPSolving.Solver.CreateSolver(problem_configuration.solver_name)
+        if self.solver is None:
+            raise ValueError(f'solver {problem_configuration.solver_name!r} is not available')
         self.problem_configuration: ProblemConfiguration = problem_configuration
+        self.rng: np.random.Generator = np.random.default_rng(problem_configuration.seed)
+        if not self.solver.SetSolverSpecificParametersAsString(problem_configuration.solver_parameters):
+            raise ValueError(f'solver rejected parameters: {problem_configuration.solver_parameters!r}')
         self.base_variables: dict[str, LPSolving.Variable] = {}
-        self.scenario_variables: dict[str, LPSolving.Variable] = {}
+        # variables of all scenarios, shaped [scenario, timeslot, ScenarioVariable]
+        self.scenario_variables: np.ndarray = np.empty((0, 0, len(ScenarioVariable)), dtype=object)
         logging.basicConfig(level=logging.DEBUG)
 
 
 
     def buildModel(self):
-        logging.debug('building base variables')
-        variables = self._buildBaseVariables()
-        logging.debug('building scenario variables')
-        scenario_variables = self._buildScenarioVariables()
-        logging.debug('finished setting up decision variables')
+        # we do not push every variable and constraint through the solver api one by one (which is super slow),
+        # instead we fill a model proto and hand it over to the solver in one go
+        model = linear_solver_pb2.MPModelProto()
 
-        logging.debug('start setting up constraints')
-        self._buildConstraints(variables, scenario_variables)
-        logging.debug('finished setting up constraints')
+        logging.debug('building base variables')
+        base_indices = self._buildBaseVariables(model)
+        logging.debug('start setting up scenario variables and constraints')
+        scenario_indices = self._buildScenarios(model, base_indices)
+        logging.debug('finished setting up scenario variables and constraints')
 
         logging.debug('start setting up objective')
-        self._buildObjective(variables, scenario_variables)
+        self._buildObjective(model, base_indices, scenario_indices)
         logging.debug('finished setting up objective')
 
+        logging.debug('loading model into solver')
+        error = self.solver.LoadModelFromProtoKeepNames(model)
+        if error:
+            raise RuntimeError(f'could not load model into solver: {error}')
+
+        # fromiter just stores the references, assigning a list into an object array makes numpy probe every single
+        # variable (through the slow swig __getattr__) whether it is an array itself
+        solver_variables = np.fromiter(self.solver.variables(), dtype=object, count=self.solver.NumVariables())
+        variables = {name: solver_variables[index] for name, index in base_indices.items()}
+        scenario_variables = solver_variables[scenario_indices]
+
         self.base_variables = variables
         self.scenario_variables = scenario_variables
         logging.debug('finished setting up model')
 
-    def _buildBaseVariables(self) -> dict[str, LPSolving.Variable]:
-        numberOfModules = self.solver.IntVar(self.problem_configuration.min_number_of_modules,
-                                             self.problem_configuration.max_number_of_modules, 'numberOfModules')
-        sizeOfStorageInKwh = self.solver.NumVar(self.problem_configuration.min_storage_size_in_kwh,
-                                                self.problem_configuration.max_storage_size_in_kwh,
-                                                'sizeOfStorageInKwh')
+    def solve(self) -> int:
+        if self.solver.IsMip():
+            return self.solver.Solve()
+
+        # an LP solver (like GLOP) just relaxes the number of modules, everything else is continuous anyway
+        # the costs are convex in the number of modules (fixing it only moves constants around in an LP),
+        # so the best whole number of modules is either right below or right above the relaxed one
+        logging.debug('solving the relaxation')
+        status = self.solver.Solve()
+        if status != Solver.OPTIMAL:
+            return status
+
+        number_of_modules = self.base_variables['numberOfModules']
+        lower_bound, upper_bound = number_of_modules.lb(), number_of_modules.ub()
+        relaxed_number_of_modules = number_of_modules.solution_value()
+        # solvers can be a little off (e.g. 200.00000000000003 at a bound of 200), so keep the candidates within the bounds
+        candidates = sorted({min(max(rounded, math.ceil(lower_bound)), math.floor(upper_bound))
+                             for rounded in (math.floor(relaxed_number_of_modules), math.ceil(relaxed_number_of_modules))})
+        costs = {}
+        try:
+            for candidate in candidates:
+                logging.debug(f'solving with {candidate} modules')
+                number_of_modules.SetBounds(candidate, candidate)
+                status = self.solver.Solve()
+                if status != Solver.OPTIMAL:
+                    return status
+                costs[candidate] = self.solver.Objective().Value()
+
+            best_number_of_modules = min(costs, key=costs.get)
+            if best_number_of_modules != candidates[-1]:
+                number_of_modules.SetBounds(best_number_of_modules, best_number_of_modules)
+                status = self.solver.Solve()
+                if status != Solver.OPTIMAL:
+                    return status
+            solution = linear_solver_pb2.MPSolutionResponse()
+            self.solver.FillSolutionResponseProto(solution)
+        finally:
+            number_of_modules.SetBounds(lower_bound, upper_bound)
+
+        # putting the bounds back throws away the solution, so we load the one of the best candidate again
+        self.solver.LoadSolutionFromProto(solution)
+        return status
+
+    def _buildBaseVariables(self, model: linear_solver_pb2.MPModelProto) -> dict[str, int]:
+        numberOfModules = len(model.variable)
+        model.variable.add(lower_bound=self.problem_configuration.min_number_of_modules,
+                           upper_bound=self.problem_configuration.max_number_of_modules,
+                           is_integer=True, name='numberOfModules')
+        sizeOfStorageInKwh = len(model.variable)
+        model.variable.add(lower_bound=self.problem_configuration.min_storage_size_in_kwh,
+                           upper_bound=self.problem_configuration.max_storage_size_in_kwh,
+                           name='sizeOfStorageInKwh')
         return {
             'numberOfModules': numberOfModules,
             'sizeOfStorageInKwh': sizeOfStorageInKwh,
         }
 
-    def _buildScenarioVariables(self) -> dict[str, dict[str, dict[str, LPSolving.Variable]]]:
-        variables = {}
-        for scenario in range(self.problem_configuration.number_of_scenarios):
-            variables[f'scenarioNr_{scenario}'] = self._buildScenarioVariablesForScenario(scenario)
-        return variables
+    def _buildScenarios(self, model: linear_solver_pb2.MPModelProto, base_variables: dict[str, int]) -> np.ndarray:
+        number_of_scenarios = self.problem_configuration.number_of_scenarios
+        number_of_timeslots = self.problem_configuration.number_of_days * 24
 
-    def _buildScenarioVariablesForScenario(self, scenario: int) -> dict[str, dict[str, LPSolving.Variable]]:
-        variables = {}
-        # we have "configuration_value" days, each day has 24 hours. For each hour we need:
-        # a variable to store the amount of energy that is currently in our storage
-        # a variable to store the amount of energy the solar panels produce
-        # a variable to store the amount of energy we consume (which is overhead but beautiful)
-        # a variable to store the amount of energy we need to buy
-        # a variable to store the amount of energy we add or take from storage
-        # a variable to store the amount of energy we can sell
+        # indices of the variables in the model, shaped [scenario, timeslot, ScenarioVariable]
+        # the scenarios are appended one after another, so the indices are just a running number
+        first_index = len(model.variable)
+        variables = np.arange(first_index, first_index + number_of_scenarios * number_of_timeslots * len(ScenarioVariable),
+                              dtype=np.int32).reshape(number_of_scenarios, number_of_timeslots, len(ScenarioVariable))
 
-        for timeslot in range(self.problem_configuration.number_of_days * 24):
-            timeslot_name = f'timeslotNr_{timeslot}'
-            variables[timeslot_name] = {
-                'storageLevel': self.solver.NumVar(0, self.problem_configuration.max_storage_size_in_kwh * 1000, f'{timeslot_name}_storagLevel'),
-                'storageEnergyDelta': self.solver.NumVar( -self.problem_configuration.max_storage_size_in_kwh * 1000, self.problem_configuration.max_storage_size_in_kwh * 1000,f'{timeslot_name}_storageEnergyDelta'),
-                'producedEnergy': self.solver.NumVar(0, self.solver.Infinity(), f'{timeslot_name}_producedEnergy'),
-                'consumedEnergy': self.solver.NumVar(0, self.solver.Infinity(), f'{timeslot_name}_consumedEnergy'),
-                'boughtEnergy': self.solver.NumVar(0, self.solver.Infinity(), f'{timeslot_name}_boughtEnergy'),
-                'soldEnergy': self.solver.NumVar(0, self.solver.Infinity(), f'{timeslot_name}_soldEnergy'),
-            }
+        for scenario_model in self._buildScenarioModels(base_variables, variables):
+            # repeated fields are concatenated when merging, so this appends the variables and constraints of the scenario
+            model.MergeFromString(scenario_model)
         return variables
 
-    def _buildConstraints(self, base_variables: dict[str, LPSolving.Variable],
-                          scenario_variables: dict[str, dict[str, LPSolving.Variable]]):
-        for scenario in range(self.problem_configuration.number_of_scenarios):
-            scenario_name = f'scenarioNr_{scenario}'
-            logging.debug(f'processing {scenario_name}')
-            current_scenario_variables = scenario_variables[scenario_name]
-            self._buildScenarioConstraints(base_variables, current_scenario_variables)
-
-    def _buildScenarioConstraints(self, base_variables, current_scenario_variables):
+    def buildScenarioSubproblems(self) -> list[linear_solver_pb2.MPModelProto]:
+        # every scenario as a model of its own: the base variables, the variables and constraints of the scenario and
+        # only the energy costs of that scenario (no investment, no averaging) - these are the subproblems of BendersMaster
+        base_model = linear_solver_pb2.MPModelProto()
+        base_indices = self._buildBaseVariables(base_model)
+
+        # all subproblems look the same, so the scenario variables have the same indices in all of them
+        first_index = len(base_model.variable)
+        variables = np.arange(first_index, first_index + self.problem_configuration.number_of_days * 24 * len(ScenarioVariable),
+                              dtype=np.int32).reshape(self.problem_configuration.number_of_days * 24, len(ScenarioVariable))
+
+        subproblems = []
+        for scenario_model in self._buildScenarioModels(base_indices, [variables] * self.problem_configuration.number_of_scenarios):
+            subproblem = linear_solver_pb2.MPModelProto()
+            subproblem.CopyFrom(base_model)
+            subproblem.MergeFromString(scenario_model)
+
+            objective_coefficients = np.zeros(len(subproblem.variable))
+            self._calculate_scenario_costs(objective_coefficients, variables,
+                                           self.problem_configuration.energy_purchase_price_per_kwh_in_euro,
+                                           self.problem_configuration.energy_selling_price_per_kwh_in_euro)
+            self._setObjective(subproblem, objective_coefficients)
+            subproblems.append(subproblem)
+        return subproblems
+
+    def _buildScenarioModels(self, base_variables: dict[str, int], scenario_variables: np.ndarray) -> list[bytes]:
+        number_of_scenarios = self.problem_configuration.number_of_scenarios
+
+        # the scenarios only share the base variables, so each one is built in its own process with its own random stream
+        rngs = self.rng.spawn(number_of_scenarios)
+        build = partial(self._buildScenarioModel, self.problem_configuration, base_variables)
+        number_of_workers = self.problem_configuration.number_of_workers or min(number_of_scenarios, os.cpu_count() or 1)
+        if number_of_workers > 1:
+            with ProcessPoolExecutor(max_workers=number_of_workers) as executor:
+                return list(executor.map(build, range(number_of_scenarios), scenario_variables, rngs))
+        return list(map(build, range(number_of_scenarios), scenario_variables, rngs))
+
+    @staticmethod
+    def _buildScenarioModel(problem_configuration: ProblemConfiguration, base_variables: dict[str, int], scenario: int,
+                            current_scenario_variables: np.ndarray, rng: np.random.Generator) -> bytes:
+        # this runs in a worker process, so we cannot touch the solver here - we return the serialized part of the model
+        logging.debug(f'processing scenarioNr_{scenario}')
+        model = linear_solver_pb2.MPModelProto()
+        StorageSelectionProblem._buildScenarioVariablesAndConstraints(model, problem_configuration, base_variables,
+                                                                      scenario, current_scenario_variables, rng)
+        return model.SerializeToString()
+
+    @staticmethod
+    def _buildScenarioVariablesAndConstraints(model: linear_solver_pb2.MPModelProto,
+                                              problem_configuration: ProblemConfiguration,
+                                              base_variables: dict[str, int], scenario: int,
+                                              current_scenario_variables: np.ndarray, rng: np.random.Generator):
         # for now, just sample sun intensity from NORM(400, 200) and afterwards min out at 0. Later we should do more clever stuff like a oscillatin (trending) sinus or anything similar
         # this is in Watt / m2, so we need to multiply by the area of the modules to get the total wattage 
-        scenario_watt_production = np.random.normal(500, 200, self.problem_configuration.number_of_days * 24)
+        scenario_watt_production = rng.normal(500, 200, problem_configuration.number_of_days * 24)
         scenario_watt_production = np.maximum(scenario_watt_production, 0)
-        scenario_watt_production_per_module = scenario_watt_production * self.problem_configuration.area_per_module_in_m2
-        scenario_watt_production_per_module = np.minimum(scenario_watt_production_per_module, self.problem_configuration.max_watts_per_module)
+        scenario_watt_production_per_module = scenario_watt_production * problem_configuration.area_per_module_in_m2
+        scenario_watt_production_per_module = np.minimum(scenario_watt_production_per_module, problem_configuration.max_watts_per_module)
 
         # we use on avg 10kw with standard deviation of 2kw
-        scenario_watt_usage = np.random.normal(10000, 2000, self.problem_configuration.number_of_days * 24)
+        scenario_watt_usage = rng.normal(10000, 2000, problem_configuration.number_of_days * 24)
         scenario_watt_usage = np.maximum(scenario_watt_usage, 0)
 
         # now it gets interesting - im doing this freehand so there might be error - but just letsa go
         # we need to make sure that the amount of energy we store is the amount of energy we produce + the amount of energy we buy - the amount of energy we sell
 
-        # we should write a generator for those slots and names and stuff but anyway
-        for timeslot in tqdm(range(self.problem_configuration.number_of_days * 24)):
-            timeslot_name = f'timeslotNr_{timeslot}'
-            last_timeslot_name = f'timeslotNr_{timeslot - 1}'
-
-            produced_energy = current_scenario_variables[timeslot_name]['producedEnergy']
-            # So this makes the produced energy variable equal to the amount of energy produced by the solar panels - easy peasy
-            self.solver.Add(produced_energy == scenario_watt_production_per_module[timeslot] * base_variables['numberOfModules'])
-
-            # As I said overhead but a cleaner model
-            consumed_energy = current_scenario_variables[timeslot_name]['consumedEnergy']
-            self.solver.Add(consumed_energy == scenario_watt_usage[timeslot])
-
-            energy_delta = produced_energy - consumed_energy
-
-            store_energy_delta = current_scenario_variables[timeslot_name]['storageEnergyDelta']
-            bought_energy = current_scenario_variables[timeslot_name]['boughtEnergy']
-            sold_energy = current_scenario_variables[timeslot_name]['soldEnergy']
+        # we have "configuration_value" days, each day has 24 hours. For each hour we need:
+        # a variable to store the amount of energy that is in our storage at the end of the hour
+        # a variable to store the amount of energy we need to buy
+        # a variable to store the amount of energy we can sell
+        # produced and consumed energy are no variables, they are constants (times the number of modules) in the energy balance
+        # the amount of energy we add or take from storage is no variable either, it is just the difference of two storage levels
+        # the variables of an hour are created right before its constraints, so we only walk over the timeslots once
+
+        # every constraint is a row lower_bound <= sum(coefficient * variable) <= upper_bound
+        # plain python floats and ints are a lot cheaper to hand to the proto than numpy scalars
+        max_storage = problem_configuration.max_storage_size_in_kwh * 1000
+        variables = model.variable
+        constraints = model.constraint
+        cur = current_scenario_variables.tolist()
+        watt_production_per_module = scenario_watt_production_per_module.tolist()
+        watt_usage = scenario_watt_usage.tolist()
+        n_modules = base_variables['numberOfModules']
+        storage_size = base_variables['sizeOfStorageInKwh']
+        # the storage level is limited by the storage size (a decision variable, so no bound), storage level - 1000 * size <= 0
+        # this row looks the same in every hour, the proto copies the list, so we can just reuse it
+        storage_capacity_coefficients = [1, -1000]
+        # storage level at the end of the last hour, there is none before the first hour
+        last_storage_level = None
+        # the loop body is tiny, so only look at the clock / redraw the progress bar every couple of thousand hours
+        for timeslot in tqdm(range(problem_configuration.number_of_days * 24), desc=f'scenarioNr_{scenario}',
+                             position=scenario, miniters=5000, mininterval=2.0,
+                             disable=not problem_configuration.verbose):
+            storage_level, bought_energy, sold_energy = cur[timeslot]
+
+            # the variables are appended in ScenarioVariable order
+            timeslot_name = f'scenarioNr_{scenario}_timeslotNr_{timeslot}'
+            variables.add(lower_bound=0, upper_bound=max_storage, name=f'{timeslot_name}_storagLevel')
+            variables.add(lower_bound=0, upper_bound=np.inf, name=f'{timeslot_name}_boughtEnergy')
+            variables.add(lower_bound=0, upper_bound=np.inf, name=f'{timeslot_name}_soldEnergy')
 
             # this seems pretty straight forward
-            # we have a delta, that must be equal to the amount sold - the amount bought + the amount stored
-            self.solver.Add(energy_delta == sold_energy + store_energy_delta - bought_energy)
-
-            storage_level = current_scenario_variables[timeslot_name]['storageLevel']
-            if timeslot == 0:
-                # we start with 0 energy in the storage
-                self.solver.Add(storage_level == 0)
-
-            if timeslot != 0:
-                # we need to make sure that the storage level is the storage level of the last timeslot + the amount of energy we add or take from storage
-                self.solver.Add(storage_level == current_scenario_variables[last_timeslot_name][
-                    'storageLevel'] + current_scenario_variables[last_timeslot_name][
-                    'storageEnergyDelta'])
+            # we have a delta (produced - consumed), that must be equal to the amount sold - the amount bought + the amount stored
+            # the produced energy is the production per module times the number of modules, the consumed energy is a constant,
+            # and the amount stored is the storage level at the end of this hour - the storage level at the end of the last hour
+            # so: produced * modules - sold - storage level + last storage level + bought == consumed
+            if last_storage_level is None:
+                # we start with 0 energy in the storage, so there is no last storage level
+                constraints.add(lower_bound=watt_usage[timeslot], upper_bound=watt_usage[timeslot],
+                                var_index=[n_modules, sold_energy, storage_level, bought_energy],
+                                coefficient=[watt_production_per_module[timeslot], -1, -1, 1])
+            else:
+                constraints.add(lower_bound=watt_usage[timeslot], upper_bound=watt_usage[timeslot],
+                                var_index=[n_modules, sold_energy, storage_level, last_storage_level, bought_energy],
+                                coefficient=[watt_production_per_module[timeslot], -1, -1, 1, 1])
 
             # Aaand, we need to at max store the amount of energy we can store - super duper straight forward
-            self.solver.Add(storage_level <= base_variables['sizeOfStorageInKwh'] * 1000)
+            constraints.add(lower_bound=-np.inf, upper_bound=0,
+                            var_index=[storage_level, storage_size],
+                            coefficient=storage_capacity_coefficients)
 
-    def _buildObjective(self, base_variables: dict[str, LPSolving.Variable],
-                        scenario_variables: dict[str, dict[str, LPSolving.Variable]]):
-        # buying costs 50 cts kWh cents, but we could also sample this of course, also per scenario
-        energy_purchase_prices = np.random.normal(0.5, 0.0, self.problem_configuration.number_of_days * 24)
+            last_storage_level = storage_level
 
-        # selling earns 12 cents, but we could also sample this of course, also per scenario
-        energy_selling_prices = np.random.normal(0.12, 0.0, self.problem_configuration.number_of_days * 24)
+    def _buildObjective(self, model: linear_solver_pb2.MPModelProto, base_variables: dict[str, int],
+                        scenario_variables: np.ndarray):
+        # for now the energy prices are the same in every timeslot, so a single number does the job
+        # (we could also sample them of course, also per scenario - then they become an array per timeslot again)
+        energy_purchase_price = self.problem_configuration.energy_purchase_price_per_kwh_in_euro
+        energy_selling_price = self.problem_configuration.energy_selling_price_per_kwh_in_euro
+
+        # the objective is linear, so instead of summing up a huge expression we just collect one coefficient per variable
+        objective_coefficients = np.zeros(len(model.variable))
 
         # now we first calculate the costs in t = 0, which is the costs for buying the solar panels and the storage
-        investment = base_variables['numberOfModules'] * self.problem_configuration.price_per_module_in_euro + \
-                     base_variables['sizeOfStorageInKwh'] * self.problem_configuration.storage_price_per_kwh_in_euro
+        objective_coefficients[base_variables['numberOfModules']] = self.problem_configuration.price_per_module_in_euro
+        objective_coefficients[base_variables['sizeOfStorageInKwh']] = self.problem_configuration.storage_price_per_kwh_in_euro
 
-        scenario_costs = []
-        # now we calculate the costs (or earnings) of each scenario
+        # now we calculate the costs (or earnings) of each scenario and average them
         logging.debug('start the recourse cost calculation')
-        for scenario in tqdm(range(self.problem_configuration.number_of_scenarios)):
-            scenario_name = f'scenarioNr_{scenario}'
-            current_scenario_variables = scenario_variables[scenario_name]
-            scenario_costs.append(self._calculate_scenario_costs(current_scenario_variables, energy_purchase_prices,
-                                                                 energy_selling_prices))
-
-        estimated_costs_during_optimization_period = 0
-        for scenario_cost in scenario_costs:
-            estimated_costs_during_optimization_period += scenario_cost
-        estimated_costs_during_optimization_period /= self.problem_configuration.number_of_scenarios
-
-        self.solver.Minimize(investment + estimated_costs_during_optimization_period)
-
-    def _calculate_scenario_costs(self, current_scenario_variables, energy_purchase_prices, energy_selling_prices):
-        costs = 0
-
-        # for each timeslot we calculate the costs by multiplying the amount of energy we buy or sell with the purchase/selling price of energy in that timeslot
-        for timeslot in range(self.problem_configuration.number_of_days * 24):
-            timeslot_name = f'timeslotNr_{timeslot}'
-            costs += (energy_purchase_prices[timeslot]) * (current_scenario_variables[timeslot_name]['boughtEnergy'] / 1000)
-            costs -= (energy_selling_prices[timeslot]) * (current_scenario_variables[timeslot_name]['soldEnergy'] / 1000)
-
-        return costs
+        for scenario in range(self.problem_configuration.number_of_scenarios):
+            self._calculate_scenario_costs(objective_coefficients, scenario_variables[scenario], energy_purchase_price,
+                                           energy_selling_price)
+        objective_coefficients[scenario_variables] /= self.problem_configuration.number_of_scenarios
+
+        self._setObjective(model, objective_coefficients)
+
+    @staticmethod
+    def _setObjective(model: linear_solver_pb2.MPModelProto, objective_coefficients: np.ndarray):
+        variables = model.variable
+        used_variables = np.flatnonzero(objective_coefficients)
+        for index, coefficient in zip(used_variables.tolist(), objective_coefficients[used_variables].tolist()):
+            variables[index].objective_coefficient = coefficient
+        model.maximize = False
+
+    def _calculate_scenario_costs(self, objective_coefficients: np.ndarray, current_scenario_variables: np.ndarray,
+                                  energy_purchase_price: float | np.ndarray, energy_selling_price: float | np.ndarray):
+        # for each timeslot the costs are the amount of energy we buy or sell (in Wh) times the purchase/selling price of energy (per kWh) in that timeslot
+        objective_coefficients[current_scenario_variables[:, ScenarioVariable.BOUGHT_ENERGY]] = energy_purchase_price / 1000
+        objective_coefficients[current_scenario_variables[:, ScenarioVariable.SOLD_ENERGY]] = -energy_selling_price / 1000